@@ -6,11 +6,42 @@ the JVS-I/O protocol as possible using commodity USB-RS485 converters.
 
 # imports
 import serial
+import os
 import time
+import threading
+import ctypes
+import ctypes.util
 from jvs_constants import *	# haters gonna hate
+from jvs_protocol import *
 
 DEBUG_TIME_FORMAT = '%Y-%m-%d, %H:%M:%S'
 
+def debug_time(timestamp = None):
+	"""Formats a timestamp for dump files, with microseconds so that bus timing can be analysed afterwards."""
+	if timestamp == None:
+		timestamp = time.time()
+	return '%s.%06d' % (time.strftime(DEBUG_TIME_FORMAT, time.localtime(timestamp)), (timestamp % 1) * 1e6)
+
+# monotonic clock for latency tracing; Python 2 has none built in, so ask the C library for CLOCK_MONOTONIC
+try:
+	monotonic = time.monotonic
+except AttributeError:
+	CLOCK_MONOTONIC = 1		# from <time.h> on Linux
+
+	class timespec(ctypes.Structure):
+		_fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+	librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+	librt.clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(timespec) ]
+
+	def monotonic():
+		"""Returns the time in seconds on a clock that never steps, unlike time.time."""
+		now = timespec()
+		if librt.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+		return now.tv_sec + now.tv_nsec * 1e-9
+
 # exceptions
 class Error(Exception):
 	"""Base class for JVS exceptions."""
@@ -62,18 +93,116 @@ class Device:
 		self.versions		= versions
 		self.capabilities	= capabilities
 
+class LatencyTracer:
+	"""Collects per-stage latency histograms for bus transactions, from sending a request until its result is written out."""
+	STAGES = [ 'send', 'first_byte', 'frame', 'delay', 'decode', 'diff', 'uinput' ]	# in the order they happen
+	BUCKETS = 24																	# power-of-two microsecond buckets, the last one catches everything from ~4.2 s up
+
+	def __init__(self):
+		self.marks = None
+		self.reset()
+
+	def reset(self):
+		"""Throws away all collected statistics."""
+		self.histograms = { }
+		for stage in self.STAGES[1:] + [ 'total' ]:
+			self.histograms[stage] = { 'count':0, 'sum':0.0, 'min':None, 'max':0.0, 'buckets':[ 0 ] * self.BUCKETS, 'negative':0 }
+
+	def begin(self):
+		"""Starts tracing a new transaction, discarding any unfinished one."""
+		self.marks = { 'send':monotonic() }
+
+	def mark(self, stage):
+		"""Records the time at which the current transaction reached the given stage."""
+		if self.marks != None:
+			self.marks[stage] = monotonic()
+
+	def end(self):
+		"""Finishes the current transaction and adds the time spent in each stage to the histograms."""
+		marks = self.marks
+		self.marks = None
+		if marks == None:
+			return
+
+		previous = marks['send']
+		for stage in self.STAGES[1:]:
+			if stage in marks:
+				self.add(stage, marks[stage] - previous)
+				previous = marks[stage]
+		self.add('total', previous - marks['send'])
+
+	def add(self, stage, seconds):
+		"""Adds a single duration to the histogram for a stage."""
+		histogram = self.histograms[stage]
+		if seconds < 0:
+			histogram['negative'] += 1	# can't happen on a monotonic clock, but keep it out of the statistics if it does
+			return
+
+		histogram['count'] += 1
+		histogram['sum'] += seconds
+		if histogram['min'] == None or seconds < histogram['min']:
+			histogram['min'] = seconds
+		if seconds > histogram['max']:
+			histogram['max'] = seconds
+		histogram['buckets'][min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)] += 1
+
+	def report(self):
+		"""Formats the histograms as a list of human-readable lines, one per stage."""
+		lines = [ ]
+		for stage in self.STAGES[1:] + [ 'total' ]:
+			histogram = self.histograms[stage]
+			if histogram['count'] == 0 and histogram['negative'] == 0:
+				continue
+
+			line = '%s: n=%d' % (stage, histogram['count'])
+			if histogram['count']:
+				buckets = [ ]
+				for (bucket, count) in enumerate(histogram['buckets']):
+					if count and bucket == self.BUCKETS - 1:
+						buckets.append('>=%dus:%d' % (1 << (bucket - 1), count))
+					elif count:
+						buckets.append('<%dus:%d' % (1 << bucket, count))
+				line += ' min=%dus avg=%dus max=%dus %s' % (histogram['min'] * 1e6,
+					histogram['sum'] / histogram['count'] * 1e6, histogram['max'] * 1e6, ' '.join(buckets))
+			if histogram['negative']:
+				line += ' negative:%d' % histogram['negative']
+			lines.append(line)
+		return lines
+
 def bcd2num(bcd):
 	"""Converts the packed dual-BCD version numbers from the protocol into a fractional value; e.g. 0x12 to 1.2."""
 	return ((bcd & 0xF0) >> 4) + ((bcd & 0x0F) * 0.1)
 
-class JVS:
-	"""Basic JVS object encapsulating all state involved in a JVS connection"""
-	def __init__(self, port, dump = False):
-		"""Initializes the JVS connection. Doesn't cause a bus reset or device enumeration to take place"""
-		self.ser = serial.Serial(port=port, baudrate=115200, timeout=5)	# initialize serial connection
+def num2bcd(num):
+	"""Converts a fractional version number into the packed dual-BCD format used by the protocol; e.g. 1.2 to 0x12."""
+	return (int(num) << 4) | int(round((num - int(num)) * 10))
+
+def encode_packet(destination, data):
+	"""Encodes a packet into the bytes that go out on the wire: sync, destination, length, data and checksum, escaped where necessary."""
+	frame = bytearray([ SYNC ])
+	checksum = 0
+	for byte in [ destination, len(data)+1 ] + list(data):
+		if byte == SYNC or byte == ESCAPE:	# escape sync/escape bytes in message
+			frame.append(ESCAPE)
+			frame.append(byte-1)
+		else:
+			frame.append(byte)
 
-		# initialize internal state
-		self.devices = []
+		checksum = (checksum + byte) % 256
+
+	if checksum == SYNC or checksum == ESCAPE:
+		frame.append(ESCAPE)
+		frame.append(checksum-1)
+	else:
+		frame.append(checksum)
+	return bytes(frame)
+
+class Bus:
+	"""Byte- and packet-level access to the bus, shared by the master and slave sides of the protocol."""
+	def __init__(self, port, dump = False, tracer = None):
+		"""Opens the serial connection to the bus."""
+		self.ser = serial.Serial(port=port, baudrate=115200, timeout=5)	# initialize serial connection
+		self.tracer = tracer	# LatencyTracer instance, or None to skip latency tracing
 
 		if dump:
 			self.dump = True
@@ -82,51 +211,60 @@ class JVS:
 		else:
 			self.dump = False
 
+	def dump_byte(self, byte, received):
+		"""Writes a byte to the dump file, starting a new line for every packet and every change of direction."""
+		if byte == SYNC or self.prev_byte_received != received:
+			self.dump_file.write('\n%s %s: %X' % (received and 'read' or 'write', debug_time(), byte))
+		else:
+			self.dump_file.write(' %X' % byte)
+		self.prev_byte_received = received
+
 	def read_byte(self):
 		"""Read a single byte, with no framing whatsoever. Used internally to read in a packet."""
 		byte = self.ser.read(1)
+		if len(byte) == 0:
+			raise TimeoutError()	# read timed out
 
+		byte = ord(byte)			# byte as number
 		if self.dump:
-			if byte == SYNC or self.prev_byte_received == False:
-				self.dump_file.write('\nread %s: %X' % (time.strftime(DEBUG_TIME_FORMAT), ord(byte)))
-			else:
-				self.dump_file.write(' %X' % ord(byte))
-			self.prev_byte_received = True
+			self.dump_byte(byte, True)
+		return byte
 
-		if len(byte) == 0:
-			raise TimeoutError()	# read timed out
-		else:
-			return ord(byte)		# return byte as number
+	def read_escaped_byte(self):
+		"""Read a single byte from inside a packet, undoing the escaping of sync/escape bytes."""
+		byte = self.read_byte()
+		if byte == ESCAPE:
+			byte = self.read_byte()+1
+		return byte
 
-	def write_byte(self, byte):
-		"""Write out a single byte with no framing. Used internally to write out a packet."""
-		self.ser.write(chr(byte))
+	def write_frame(self, frame):
+		"""Write out a packet encoded by encode_packet in one go."""
+		self.ser.write(frame)
 
 		if self.dump:
-			if byte == SYNC or self.prev_byte_received == True:
-				self.dump_file.write('\nwrite %s: %X' % (time.strftime(DEBUG_TIME_FORMAT), byte))
-			else:
-				self.dump_file.write(' %X' % byte)
-			self.prev_byte_received = False
+			for byte in bytearray(frame):
+				self.dump_byte(byte, False)
 
 	def read_packet(self):
-		"""Reads a full packet from the bus. Returns a Packet instance or throws TimeoutError."""
+		"""Reads a full packet from the bus. Returns the destination and data or throws TimeoutError."""
 		byte = 0
 		while byte != SYNC:	# look for sync
 			byte = self.read_byte()
+		if self.tracer:
+			self.tracer.mark('first_byte')
 
-		destination = self.read_byte()
-		length = self.read_byte()
+		destination = self.read_escaped_byte()
+		length = self.read_escaped_byte()
 		data = []
-		checksum_computed = destination+length
+		checksum_computed = (destination+length) % 256
 		for _ in range(1, length):   # message contents
-			byte = self.read_byte()
-			if byte == ESCAPE:
-				byte = self.read_byte()+1
+			byte = self.read_escaped_byte()
 			data.append(byte)
 			checksum_computed = (checksum_computed + byte) % 256   # compute checksum
 
-		checksum_received = self.read_byte()   # received checksum
+		checksum_received = self.read_escaped_byte()   # received checksum
+		if self.tracer:
+			self.tracer.mark('frame')
 		if checksum_received == checksum_computed:
 			return destination, data
 		else:
@@ -134,22 +272,21 @@ class JVS:
 
 	def write_packet(self, destination, data):
 		"""Writes a full packet to the bus."""
-		self.write_byte(SYNC)
-		self.write_byte(destination)
-		self.write_byte(len(data)+1)
-		checksum = destination+len(data)+1
-		for byte in data:
-			if byte == SYNC or byte == ESCAPE:	# escape sync/escape bytes in message
-				self.write_byte(ESCAPE)
-				self.write_byte(byte-1)
-			else:
-				self.write_byte(byte)
+		self.write_frame(encode_packet(destination, data))
 
-			checksum = (checksum + byte) % 256
-		self.write_byte(checksum)
+class JVS(Bus):
+	"""Basic JVS object encapsulating all state involved in a JVS connection"""
+	def __init__(self, port, dump = False, tracer = None):
+		"""Initializes the JVS connection. Doesn't cause a bus reset or device enumeration to take place"""
+		Bus.__init__(self, port, dump, tracer)
+
+		# initialize internal state
+		self.devices = []
 
 	def cmd(self, addr, cmd):
 		"""Writes a packet to the bus and listens back, then reads out status and report codes and throws relevant errors if necessary."""
+		if self.tracer:
+			self.tracer.begin()
 		self.write_packet(addr, cmd)
 		dest, data = self.read_packet()
 
@@ -162,50 +299,13 @@ class JVS:
 			raise ReportError(cmd[0], data[1])			# report error -- error with this command in particular
 
 		time.sleep(CMD_DELAY)
+		if self.tracer:
+			self.tracer.mark('delay')
 		return data[2:]									# slice off status and report codes
 
 	def get_capabilities(self, addr):
 		"""Requests capability data from the device indicated by addr and formats it into a more Python-friendly data structure."""
-		data = self.cmd(addr, [ CMD_CAPABILITIES ])
-		position = 0
-		capabilities = { }
-		while position < len(data):
-			if   data[position] == CAP_END:		break
-
-			# inputs
-			elif data[position] == CAP_PLAYERS:
-				capabilities['switches'] = { 'players':data[position+1], 'switches':data[position+2] }
-			elif data[position] == CAP_COINS:
-				capabilities['coins'] = data[position+1]
-			elif data[position] == CAP_ANALOG_IN:
-				capabilities['analog_in'] = { 'channels':data[position+1], 'bits':data[position+2] }
-			elif data[position] == CAP_ROTARY:
-				capabilities['rotary'] = data[position+1]
-			elif data[position] == CAP_KEYPAD:
-				capabilities['keypad'] = True
-			elif data[position] == CAP_LIGHTGUN:
-				capabilities['lightgun'] = { 'xbits':data[position+1], 'ybits':data[position+2], 'channels':data[position+3] }
-			elif data[position] == CAP_GPI:
-				capabilities['gpi'] = (data[position+1]<<8) | data[position+2]
-
-
-			# outputs
-			elif data[position] == CAP_CARD:
-				capabilities['card'] = data[position+1]
-			elif data[position] == CAP_HOPPER:
-				capabilities['hopper'] = data[position+1]
-			elif data[position] == CAP_GPO:
-				capabilities['gpo'] = data[position+1]
-			elif data[position] == CAP_ANALOG_OUT:
-				capabilities['analog_out'] = data[position+1]
-			elif data[position] == CAP_DISPLAY:
-				capabilities['display'] = { 'cols':data[position+1], 'rows':data[position+2], 'enc':ENCODINGS[data[position+3]] }
-			elif data[position] == CAP_BACKUP:
-				capabilities['backup'] = True
-
-			position += 4
-
-		return capabilities
+		return decode_capabilities(self.cmd(addr, [ CMD_CAPABILITIES ]))
 
 	def reset(self, num_devices = None):
 		"""Sends a bus reset and initializes all devices."""
@@ -251,29 +351,267 @@ class JVS:
 		"""Reads out the switch states of a given device. Return value is a list of dicts by player and then by button type. Player 0 contains the general switch states."""
 		data = self.cmd(addr, [ CMD_READ_SWITCHES, num_players, 2 ])	# execute command -- always read 2 bytes/player
 
-		ret = [ ]
-		ret.append({	 'test':bool(data[0] & BTN_GENERAL_TEST),
-						'tilt1':bool(data[0] & BTN_GENERAL_TILT1),
-						'tilt2':bool(data[0] & BTN_GENERAL_TILT2),
-						'tilt3':bool(data[0] & BTN_GENERAL_TILT3) })
-
-		for player in range(0, num_players):
-			ret.append({	  'start':bool(data[player*2+1] & BTN_PLAYER_START),
-							'service':bool(data[player*2+1] & BTN_PLAYER_SERVICE),
-							     'up':bool(data[player*2+1] & BTN_PLAYER_UP),
-							   'down':bool(data[player*2+1] & BTN_PLAYER_DOWN),
-							   'left':bool(data[player*2+1] & BTN_PLAYER_LEFT),
-							  'right':bool(data[player*2+1] & BTN_PLAYER_RIGHT),
-							  'start':bool(data[player*2+1] & BTN_PLAYER_START),
-							  'push1':bool(data[player*2+1] & BTN_PLAYER_PUSH1),
-							  'push2':bool(data[player*2+1] & BTN_PLAYER_PUSH2),
-
-							  'push3':bool(data[player*2+2] & BTN_PLAYER_PUSH3),
-							  'push4':bool(data[player*2+2] & BTN_PLAYER_PUSH4),
-							  'push5':bool(data[player*2+2] & BTN_PLAYER_PUSH5),
-							  'push6':bool(data[player*2+2] & BTN_PLAYER_PUSH6),
-							  'push7':bool(data[player*2+2] & BTN_PLAYER_PUSH7),
-							  'push8':bool(data[player*2+2] & BTN_PLAYER_PUSH8),
-							  'push9':bool(data[player*2+2] & BTN_PLAYER_PUSH9)})
+		ret = decode_switches(data, num_players, 2)
 
+		if self.tracer:
+			self.tracer.mark('decode')
 		return ret
+
+class JVSSlave(Bus):
+	"""
+	Emulates an I/O board on the bus, answering the master from an in-memory table of input states.
+
+	Replies are encoded ahead of time and only re-encoded when the inputs they depend on change, so answering a
+	request is a dictionary lookup and a single write. The sense line towards the master is expected on DTR.
+	"""
+	HANDLED_COMMANDS = [ CMD_CONVEY_ID, CMD_READ_SWITCHES, CMD_READ_COINS, CMD_READ_ANALOGS, CMD_DECREASE_COINS ]	# besides the static replies
+
+	def __init__(self, port, id_data, capabilities, versions = None, chained = False, dump = False):
+		"""
+		Opens the bus and sets up the input table. id_data is a list of strings as in Device.id_data, capabilities a
+		dict as returned by JVS.get_capabilities and versions a dict as in Device.versions. If chained is set, an
+		address is only accepted once the devices further down the chain, seen on CD, have been addressed.
+		"""
+		Bus.__init__(self, port, dump)
+
+		if versions == None:
+			versions = { 'command':1.3, 'jvs':3.0, 'comms':1.0 }
+
+		self.id_data		= id_data
+		self.capabilities	= capabilities
+		self.versions		= versions
+		self.chained		= chained
+
+		# input state table, laid out exactly as it goes out in replies
+		if 'switches' in capabilities:
+			self.players			= capabilities['switches']['players']
+			self.player_bytes		= (capabilities['switches']['switches'] + 7) // 8
+		else:
+			self.players			= 0
+			self.player_bytes		= 0
+		self.switches	= bytearray(1 + self.players * self.player_bytes)
+		self.coins		= bytearray(2 * capabilities.get('coins', 0))
+		self.analogs	= bytearray(2 * capabilities.get('analog_in', { }).get('channels', 0))
+		if 'analog_in' in capabilities:
+			self.analog_shift	= 16 - capabilities['analog_in']['bits']	# values are sent left-aligned
+		else:
+			self.analog_shift	= 0
+
+		# static replies, encoded once
+		id_string = bytearray(';'.join(id_data))
+		self.static_replies = {
+			CMD_REQUEST_ID:			[ REPORT_SUCCESS ] + list(id_string) + [ 0 ],
+			CMD_COMMAND_VERSION:	[ REPORT_SUCCESS, num2bcd(versions['command']) ],
+			CMD_JVS_VERSION:		[ REPORT_SUCCESS, num2bcd(versions['jvs']) ],
+			CMD_COMMS_VERSION:		[ REPORT_SUCCESS, num2bcd(versions['comms']) ],
+			CMD_CAPABILITIES:		[ REPORT_SUCCESS ] + encode_capabilities(capabilities) }
+
+		# encoded reply frames by request data, and the inputs each one depends on
+		self.frames			= { }
+		self.frame_inputs	= { }
+		self.last_frame		= None
+		self.lock			= threading.Lock()	# serializes input updates with building frames
+
+		self.mainboard_id	= None
+		self.running		= False
+		self.address		= None
+		self.set_sense(True)
+
+	def set_sense(self, unaddressed):
+		"""Drives the sense line, which tells the master whether there are devices left to address."""
+		self.ser.setDTR(unaddressed)
+
+	# input side
+	def set_switches(self, player, states):
+		"""Sets a number of switches of one player at once from a dict of names and booleans. Player 0 holds the general switches."""
+		if player < 0 or player > self.players:
+			raise ValueError("Player %d does not exist; the board has %d players." % (player, self.players))
+
+		# work out where every switch goes before touching the state, so a bad name leaves it unchanged
+		bits = [ ]
+		for (name, pressed) in states.items():
+			if player == 0:
+				switches = GENERAL_SWITCHES
+			else:
+				switches = PLAYER_SWITCHES
+			if name not in switches:
+				raise ValueError("Unknown switch name %r." % name)
+
+			(offset, mask) = switches[name]
+			if player != 0:
+				if offset >= self.player_bytes:
+					raise ValueError("Switch %r does not exist; the board has %d switches per player." % (name, self.capabilities['switches']['switches']))
+				offset += 1 + (player-1) * self.player_bytes
+			bits.append((offset, mask, pressed))
+
+		with self.lock:
+			changed = False
+			for (offset, mask, pressed) in bits:
+				old = self.switches[offset]
+				if pressed:
+					self.switches[offset] = old | mask
+				else:
+					self.switches[offset] = old & ~mask
+				changed = changed or self.switches[offset] != old
+
+			if changed:
+				self.refresh('switches')
+
+	def set_switch(self, player, name, pressed):
+		"""Sets the state of a single switch, named as in the dicts returned by JVS.read_switches."""
+		self.set_switches(player, { name:pressed })
+
+	def set_coins(self, slot, count):
+		"""Sets the coin counter of a slot, numbered from 1."""
+		if slot < 1 or slot > len(self.coins) // 2:
+			raise ValueError("Coin slot %d does not exist; the board has %d slots." % (slot, len(self.coins) // 2))
+		if count < 0 or count > 0x3FFF:
+			raise ValueError("Coin count %d does not fit in 14 bits." % count)
+
+		with self.lock:
+			self.coins[(slot-1)*2]		= count >> 8	# top two bits are the slot condition, always normal
+			self.coins[(slot-1)*2+1]	= count & 0xFF
+			self.refresh('coins')
+
+	def set_analog(self, channel, value):
+		"""Sets an analog input, numbered from 1, to a value of as many bits as the capabilities declare."""
+		if channel < 1 or channel > len(self.analogs) // 2:
+			raise ValueError("Analog channel %d does not exist; the board has %d channels." % (channel, len(self.analogs) // 2))
+		if value < 0 or value >= 1 << (16 - self.analog_shift):
+			raise ValueError("Analog value %d does not fit in %d bits." % (value, 16 - self.analog_shift))
+
+		value <<= self.analog_shift
+		with self.lock:
+			self.analogs[(channel-1)*2]		= value >> 8
+			self.analogs[(channel-1)*2+1]	= value & 0xFF
+			self.refresh('analogs')
+
+	def refresh(self, inputs):
+		"""Re-encodes every cached frame that depends on the given inputs. Must be called with the lock held."""
+		frames = dict(self.frames)
+		for (request, frame_inputs) in self.frame_inputs.items():
+			if inputs in frame_inputs:
+				frames[request] = self.build_reply(request)[0]
+		self.frames = frames	# swapped in whole, so the bus side never needs the lock for a lookup
+
+	# bus side
+	def build_reply(self, request):
+		"""
+		Encodes the reply to a request. Returns the frame, the inputs it depends on, and whether it may be cached.
+		Side effects of the request only take place once all of it has been found to be supported.
+		"""
+		commands = split_commands(request)
+		for (cmd, args) in commands:
+			if args == None or not (cmd in self.static_replies or cmd in self.HANDLED_COMMANDS):
+				return encode_packet(BUS_MASTER, [ STATUS_UNSUPPORTED ]), set(), False	# unknown command or cut short
+
+		data = [ STATUS_SUCCESS ]
+		inputs = set()
+		cacheable = True
+		coins = bytearray(self.coins)	# coin decreases are applied to this copy until the reply is complete
+		mainboard_id = None
+		for (cmd, args) in commands:
+			if cmd in self.static_replies:
+				data += self.static_replies[cmd]
+			elif cmd == CMD_CONVEY_ID:
+				mainboard_id = str(bytearray(args[:-1]))
+				data.append(REPORT_SUCCESS)
+				cacheable = False
+			elif cmd == CMD_READ_SWITCHES:
+				if args[0] > self.players or args[1] > self.player_bytes:
+					data.append(REPORT_PARAMETER_ERROR1)
+					continue
+				data.append(REPORT_SUCCESS)
+				data.append(self.switches[0])
+				for player in range(0, args[0]):
+					base = 1 + player * self.player_bytes
+					data += list(self.switches[base:base+args[1]])
+				inputs.add('switches')
+			elif cmd == CMD_READ_COINS:
+				if args[0]*2 > len(coins):
+					data.append(REPORT_PARAMETER_ERROR1)
+					continue
+				data.append(REPORT_SUCCESS)
+				data += list(coins[:args[0]*2])
+				inputs.add('coins')
+			elif cmd == CMD_READ_ANALOGS:
+				if args[0]*2 > len(self.analogs):
+					data.append(REPORT_PARAMETER_ERROR1)
+					continue
+				data.append(REPORT_SUCCESS)
+				data += list(self.analogs[:args[0]*2])
+				inputs.add('analogs')
+			elif cmd == CMD_DECREASE_COINS:
+				if args[0] < 1 or args[0] > len(coins) // 2:
+					data.append(REPORT_PARAMETER_ERROR1)
+					continue
+				offset = (args[0]-1) * 2
+				count = max(((coins[offset] & 0x3F) << 8 | coins[offset+1]) - (args[1] << 8 | args[2]), 0)
+				coins[offset]	= count >> 8
+				coins[offset+1]	= count & 0xFF
+				data.append(REPORT_SUCCESS)
+				cacheable = False
+
+		# the whole request has been handled, so now apply its side effects
+		if mainboard_id != None:
+			self.mainboard_id = mainboard_id
+		if coins != self.coins:
+			self.coins = coins
+			self.refresh('coins')
+
+		return encode_packet(BUS_MASTER, data), inputs, cacheable
+
+	def handle_broadcast(self, data):
+		"""Handles a packet sent to all devices: bus reset and address assignment."""
+		if len(data) < 2:
+			return
+
+		if data[0] == CMD_RESET and data[1] == CMD_RESET_ARG:
+			self.address = None
+			self.set_sense(True)
+		elif data[0] == CMD_ASSIGN_ADDR and self.address == None:
+			if self.chained and self.ser.getCD():
+				return		# a device further down the chain still needs its address first
+
+			self.address = data[1]
+			self.set_sense(False)
+			self.write_frame(encode_packet(BUS_MASTER, [ STATUS_SUCCESS, REPORT_SUCCESS ]))
+
+	def handle_packet(self):
+		"""Reads one packet from the bus and answers it if it is addressed to us. Bad and timed-out packets are ignored; the master will retry."""
+		try:
+			destination, data = self.read_packet()
+		except (TimeoutError, ChecksumError):
+			return
+
+		if destination == BROADCAST:
+			self.handle_broadcast(data)
+			return
+		if self.address == None or destination != self.address:
+			return
+
+		if data == [ CMD_RETRANSMIT ] and self.last_frame != None:
+			self.write_frame(self.last_frame)
+			return
+
+		request = tuple(data)
+		frame = self.frames.get(request)
+		if frame == None:
+			with self.lock:
+				(frame, inputs, cacheable) = self.build_reply(request)
+				if cacheable:
+					self.frames[request] = frame
+					self.frame_inputs[request] = inputs
+
+		self.write_frame(frame)
+		self.last_frame = frame
+
+	def serve(self):
+		"""Answers the master until stop() is called, which takes effect within one serial time-out."""
+		self.running = True
+		while self.running:
+			self.handle_packet()
+
+	def stop(self):
+		"""Makes serve() return, e.g. from another thread or a signal handler."""
+		self.running = False
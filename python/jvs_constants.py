@@ -45,13 +45,18 @@ CMD_READ_ROTARY		= 0x23	# read rotary encoder inputs
 CMD_READ_KEYPAD		= 0x24	# read keypad inputs
 CMD_READ_LIGHTGUN	= 0x25	# read light gun inputs
 CMD_READ_GPI		= 0x26	# read general-purpose inputs
+CMD_READ_PAYOUTS	= 0x2E	# read number of payouts remaining
 
 CMD_RETRANSMIT		= 0x2F	# ask device to retransmit data
 CMD_DECREASE_COINS	= 0x30	# decrease number of coins
-
+CMD_PAYOUT			= 0x31	# do a payout?
 CMD_WRITE_GPO		= 0x32	# write to general-purpose outputs
 CMD_WRITE_ANALOG	= 0x33	# write to analog outputs
 CMD_WRITE_DISPLAY	= 0x34	# write to an alphanumeric display
+CMD_INCREASE_COINS	= 0x35	# output coins?
+CMD_DECREASE_PAYOUTS	= 0x36	# subtract payouts?
+CMD_WRITE_GPO2		= 0x37	# write to general-purpose outputs, second form
+CMD_WRITE_GPO3		= 0x38	# write to general-purpose outputs, third form
 
 # manufacturer-specific
 CMD_MANUFACTURER_START	= 0x60	# start of manufacturer-specific commands
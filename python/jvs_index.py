@@ -0,0 +1,271 @@
+# jvs-index.py
+"""
+Offline analysis of bus captures, as written by jvs_master.py --dump or
+jvs_snoop.py --raw. A capture is parsed once into a columnar index stored
+next to it, which the queries then work from without touching the capture.
+"""
+
+# imports
+import argparse
+import array
+import os
+import re
+import sys
+import time
+
+import numpy
+
+import jvs
+import jvs_protocol
+from jvs_constants import *
+
+INDEX_SUFFIX = '.idx.npz'
+
+# a line of a capture: direction, timestamp with optional microseconds, bytes in hex
+LINE_RE = re.compile(r'^(read|write) (\d{4}-\d\d-\d\d, \d\d:\d\d:\d\d)(\.\d+)?: ([0-9A-Fa-f ]+)$')
+
+DIRECTION_WRITE	= 0		# request from the master
+DIRECTION_READ	= 1		# reply to the master
+
+class CaptureIndex:
+	"""
+	Columnar index of the packets in a capture, one row per packet. Every column is a numpy array, so
+	queries can be written as vectorised operations over them:
+
+	- time:				seconds since the epoch
+	- direction:		DIRECTION_WRITE or DIRECTION_READ
+	- address:			device address; for replies, that of the request they answer
+	- command:			first command code; for replies, that of the request they answer
+	- status:			status code of replies, 0 for requests
+	- request:			for replies, the row of the request they answer, otherwise -1
+	- valid:			whether the checksum matched
+	- offset:			byte offset of the packet's line in the capture
+	- payload_start:	start of the packet's unescaped data in payload
+	- payload_length:	length of the packet's unescaped data
+	- payload:			data of all packets, concatenated
+	"""
+	COLUMNS = [ 'time', 'direction', 'address', 'command', 'status', 'request', 'valid', 'offset', 'payload_start', 'payload_length', 'payload' ]
+
+	def __init__(self, filename, columns):
+		self.filename = filename
+		for name in self.COLUMNS:
+			setattr(self, name, columns[name])
+
+	@classmethod
+	def build(cls, filename):
+		"""Parses a capture into an index. Reads the capture line by line, so it does not need to fit in memory."""
+		columns = {
+			'time':				array.array('d'),
+			'direction':		array.array('B'),
+			'address':			array.array('B'),
+			'command':			array.array('B'),
+			'status':			array.array('B'),
+			'request':			array.array('l'),
+			'valid':			array.array('B'),
+			'offset':			array.array('l'),
+			'payload_start':	array.array('l'),
+			'payload_length':	array.array('l'),
+			'payload':			array.array('B') }
+		seconds_cache = { }		# many packets share a second, so only parse each one once
+		last_request = -1
+		row = 0
+		offset = 0
+
+		capture = open(filename, 'rb')
+		for line in capture:
+			line_offset = offset
+			offset += len(line)
+
+			match = LINE_RE.match(line.strip())
+			if match == None:
+				continue
+			(direction, seconds, fraction, hex_bytes) = match.groups()
+
+			# unescape the packet, skipping lines that don't hold a whole one
+			raw = [ int(byte, 16) for byte in hex_bytes.split() ]
+			if len(raw) < 4 or raw[0] != SYNC:
+				continue
+			data = [ ]
+			position = 1
+			while position < len(raw):
+				if raw[position] == ESCAPE and position+1 < len(raw):
+					data.append(raw[position+1]+1)
+					position += 2
+				else:
+					data.append(raw[position])
+					position += 1
+			(destination, length, payload, checksum) = (data[0], data[1], data[2:-1], data[-1])
+
+			if seconds not in seconds_cache:
+				seconds_cache[seconds] = time.mktime(time.strptime(seconds, jvs.DEBUG_TIME_FORMAT))
+			timestamp = seconds_cache[seconds] + float(fraction or 0)
+
+			if direction == 'write':
+				columns['direction'].append(DIRECTION_WRITE)
+				columns['address'].append(destination)
+				columns['command'].append(payload and payload[0] or 0)
+				columns['status'].append(0)
+				columns['request'].append(-1)
+				last_request = row
+			else:
+				columns['direction'].append(DIRECTION_READ)
+				if last_request >= 0:
+					columns['address'].append(columns['address'][last_request])
+					columns['command'].append(columns['command'][last_request])
+				else:
+					columns['address'].append(destination)
+					columns['command'].append(0)
+				columns['status'].append(payload and payload[0] or 0)
+				columns['request'].append(last_request)
+				last_request = -1	# a request only gets one reply
+
+			columns['time'].append(timestamp)
+			columns['valid'].append(len(payload) == length-1 and sum(data[:-1]) % 256 == checksum)
+			columns['offset'].append(line_offset)
+			columns['payload_start'].append(len(columns['payload']))
+			columns['payload_length'].append(len(payload))
+			columns['payload'].extend(payload)
+			row += 1
+		capture.close()
+
+		return cls(filename, dict((name, numpy.array(column)) for (name, column) in columns.items()))
+
+	@classmethod
+	def load(cls, filename, rebuild = False):
+		"""Loads the index of a capture, building and saving it first if it is missing or older than the capture."""
+		index_filename = filename + INDEX_SUFFIX
+		source = os.stat(filename)
+		if not rebuild and os.path.exists(index_filename):
+			stored = numpy.load(index_filename)
+			try:
+				if stored['source_size'] == source.st_size and stored['source_mtime'] == source.st_mtime:
+					return cls(filename, dict((name, stored[name]) for name in cls.COLUMNS))
+			finally:
+				stored.close()
+
+		index = cls.build(filename)
+		index.save(index_filename, source)
+		return index
+
+	def save(self, index_filename, source):
+		"""Writes the index out, along with the size and modification time of the capture to detect it going stale."""
+		columns = dict((name, getattr(self, name)) for name in self.COLUMNS)
+		index_file = open(index_filename, 'wb')
+		numpy.savez(index_file, source_size=source.st_size, source_mtime=source.st_mtime, **columns)
+		index_file.close()
+
+	def select(self, start = None, end = None, address = None, command = None, direction = None):
+		"""Returns the rows matching all of the given conditions. start and end are in seconds since the start of the capture."""
+		mask = numpy.ones(len(self.time), dtype=bool)
+		if len(self.time) and start != None:
+			mask &= self.time >= self.time[0] + start
+		if len(self.time) and end != None:
+			mask &= self.time < self.time[0] + end
+		if address != None:
+			mask &= self.address == address
+		if command != None:
+			mask &= self.command == command
+		if direction != None:
+			mask &= self.direction == direction
+		return numpy.nonzero(mask)[0]
+
+	def turnarounds(self, rows):
+		"""Returns the time between request and reply, in seconds, for every reply among the given rows."""
+		rows = rows[(self.direction[rows] == DIRECTION_READ) & (self.request[rows] >= 0)]
+		return self.time[rows] - self.time[self.request[rows]]
+
+	def switch_timeline(self, rows, player, switch):
+		"""Returns the times at which a switch changed state among the given rows, and the states it changed to."""
+		if player == 0:
+			(byte, mask) = jvs_protocol.GENERAL_SWITCHES[switch]
+		else:
+			(byte, mask) = jvs_protocol.PLAYER_SWITCHES[switch]
+
+		# successful replies to well-formed switch reads that include this player
+		rows = rows[(self.direction[rows] == DIRECTION_READ) & (self.command[rows] == CMD_READ_SWITCHES) &
+			(self.request[rows] >= 0) & (self.status[rows] == STATUS_SUCCESS) & self.valid[rows].astype(bool) &
+			(self.payload_length[rows] >= 2)]
+		rows = rows[(self.payload_length[self.request[rows]] >= 3) & (self.payload[self.payload_start[rows]+1] == REPORT_SUCCESS)]
+		request_start = self.payload_start[self.request[rows]]
+		players = self.payload[request_start+1].astype(int)
+		player_bytes = self.payload[request_start+2].astype(int)
+		complete = (players >= player) & (self.payload_length[rows] >= 2 + 1 + players * player_bytes)	# status, report, general byte, player bytes
+		if player != 0:
+			complete &= player_bytes > byte		# reads of fewer bytes per player don't contain this switch
+		rows = rows[complete]
+		player_bytes = player_bytes[complete]
+
+		# reply data is status, report, general byte, then the bytes of each player
+		if player == 0:
+			positions = self.payload_start[rows] + 2 + byte
+		else:
+			positions = self.payload_start[rows] + 3 + (player-1) * player_bytes + byte
+		states = (self.payload[positions] & mask) != 0
+
+		changes = numpy.concatenate([ [ True ], states[1:] != states[:-1] ]) if len(states) else numpy.zeros(0, dtype=bool)
+		return self.time[rows[changes]], states[changes]
+
+	def lines(self, rows):
+		"""Reads the capture lines of the given rows back from the capture, by seeking to their offsets."""
+		capture = open(self.filename, 'rb')
+		for row in rows:
+			capture.seek(self.offset[row])
+			yield capture.readline().rstrip('\n')
+		capture.close()
+
+# command line
+def show_frames(index, rows, args):
+	for line in index.lines(rows):
+		print(line)
+
+def show_stats(index, rows, args):
+	if len(rows) == 0:
+		print("No packets selected.")
+		return
+
+	print("%d packets over %.3f s, %d with bad checksums" % (len(rows), index.time[rows[-1]] - index.time[rows[0]], len(rows) - numpy.count_nonzero(index.valid[rows])))
+	requests = rows[index.direction[rows] == DIRECTION_WRITE]
+	print("Requests by address and command:")
+	for address in numpy.unique(index.address[requests]):
+		at_address = requests[index.address[requests] == address]
+		(commands, counts) = numpy.unique(index.command[at_address], return_counts=True)
+		print("\t- Address %d:" % address)
+		for (command, count) in zip(commands, counts):
+			print("\t\t- %02X (%s): %d" % (command, jvs_protocol.describe_command(command), count))
+
+	turnarounds = index.turnarounds(rows) * 1e6
+	if len(turnarounds):
+		print("Turnaround: n=%d min=%dus median=%dus p99=%dus max=%dus" % (len(turnarounds), turnarounds.min(),
+			numpy.median(turnarounds), numpy.percentile(turnarounds, 99), turnarounds.max()))
+	print("Unanswered requests: %d" % (len(requests) - len(index.turnarounds(rows))))
+
+def show_timeline(index, rows, args):
+	(times, states) = index.switch_timeline(rows, args.player, args.switch)
+	for (timestamp, state) in zip(times, states):
+		print("%s %s" % (jvs.debug_time(timestamp), state and 'pressed' or 'released'))
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('capture', metavar='CAPTURE', help='Capture file to analyse; its index is stored as CAPTURE%s' % INDEX_SUFFIX)
+parser.add_argument('--rebuild', action='store_true', default=False, help='Rebuild the index even if it is up to date')
+parser.add_argument('--start', type=float, default=None, metavar='SECONDS', help='Only look at packets from SECONDS after the start of the capture')
+parser.add_argument('--end', type=float, default=None, metavar='SECONDS', help='Only look at packets until SECONDS after the start of the capture')
+parser.add_argument('-a', '--address', type=int, default=None, metavar='N', help='Only look at packets to and from address N')
+parser.add_argument('--command', type=lambda code: int(code, 16), default=None, metavar='CODE', help='Only look at packets for command CODE, in hex')
+subparsers = parser.add_subparsers()
+
+frames_parser = subparsers.add_parser('frames', help='Print the selected packets')
+frames_parser.set_defaults(action=show_frames)
+
+stats_parser = subparsers.add_parser('stats', help='Show packet counts and turnaround statistics')
+stats_parser.set_defaults(action=show_stats)
+
+timeline_parser = subparsers.add_parser('timeline', help='Show when a switch was pressed and released')
+timeline_parser.add_argument('player', type=int, help='Player number, 0 for the general switches')
+timeline_parser.add_argument('switch', help='Switch name, e.g. start or push1')
+timeline_parser.set_defaults(action=show_timeline)
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	index = CaptureIndex.load(args.capture, args.rebuild)
+	rows = index.select(args.start, args.end, args.address, args.command)
+	args.action(index, rows, args)
@@ -15,17 +15,76 @@ import os
 import traceback
 import signal
 import time
+import threading
+import collections
 
 import daemon
 import daemon.pidlockfile
 
-# dump a message to stdout if verbose option is high enough
-def verbose(level, message):
-	global args, log_file
+LOG_QUEUE_SIZE		= 4096	# messages waiting for the log thread, any more are dropped
+
+# log state, shared between the poll loop and the log thread
+log_queue	= collections.deque()
+log_dropped	= 0
+log_stop	= False
+log_thread	= None
+log_event	= threading.Event()	# set when there is something for the log thread to do
+
+# queue a message for the log if verbose option is high enough; formatting and writing happen on the log thread
+def verbose(level, message, *message_args):
+	global log_dropped
 	if args.verbose >= level:
-		log_file.write("%s %d %s\n" % (time.strftime('[%Y-%m-%d %H:%M:%S]'), level, message))
+		if len(log_queue) < LOG_QUEUE_SIZE:
+			log_queue.append((time.time(), level, message, message_args))	# deque appends never block, unlike Queue
+		else:
+			log_dropped += 1
+		if not log_event.is_set():
+			log_event.set()
+
+# write out a single log line
+def write_log(timestamp, level, message):
+	log_file.write("%s %d %s\n" % (time.strftime('[%Y-%m-%d %H:%M:%S]', time.localtime(timestamp)), level, message))
+
+# log thread: format queued messages and write them out, so the poll loop never waits on the disk
+def log_writer():
+	dropped_reported = 0
+	while not (log_stop and not log_queue):
+		log_event.wait()
+		log_event.clear()				# before draining, so messages queued meanwhile wake us up again
+
+		while log_queue:
+			(timestamp, level, message, message_args) = log_queue.popleft()
+			try:
+				if message_args:
+					message = message % message_args
+				write_log(timestamp, level, message)
+			except Exception:			# a bad message must not take the log thread down with it
+				try:
+					write_log(timestamp, level, "Could not format log message %r with arguments %r" % (message, message_args))
+				except Exception:
+					pass
+
+		if log_dropped != dropped_reported:
+			write_log(time.time(), 0, "Log queue full, dropped %d messages." % (log_dropped - dropped_reported))
+			dropped_reported = log_dropped
 		log_file.flush()				# make sure we can see events in the file after they've happened
 
+def start_logging():
+	global log_stop, log_thread
+	log_stop = False
+	log_thread = threading.Thread(target=log_writer, name='log writer')
+	log_thread.daemon = True
+	log_thread.start()
+
+# write out everything still queued and stop the log thread
+def stop_logging():
+	global log_stop, log_thread
+	if log_thread != None:
+		log_stop = True
+		log_event.set()
+		log_thread.join()
+		log_thread = None
+
 # read in config file
 def read_config():
 	global args, log_file
@@ -34,22 +93,31 @@ def read_config():
 	parser.add_argument('-p', '--pid-file',  default='/var/run/openjvs.pid', metavar='FILE', help='Use file FILE as a PID-file to daemonise')
 	parser.add_argument('-c', '--config', dest='config_filename', default='jvs_master.cfg', metavar='FILENAME', help='use file FILENAME as config file')
 	parser.add_argument('--assume-devices', type=int, default=None, metavar='N', help='If given, skip regular address setting procedure and assume N devices connected.')
-	parser.add_argument('-v', dest='verbose', action='count', help='Enter verbose mode, which shows more information on the bus traffic. Use more than once for more output.')
+	parser.add_argument('-v', dest='verbose', action='count', default=0, help='Enter verbose mode, which shows more information on the bus traffic. Use more than once for more output.')
 	parser.add_argument('-d', '--debug', dest='verbose', action='store_const', const=5, help='Turns verbosity all the way up to maximum, as a debugging aid.')
 	parser.add_argument('--no-daemon', action='store_true', help='Do not fork away into a daemon process after initialization')
 	parser.add_argument('-l', '--log-file', metavar='FILE', help='Log to <FILE> instead of to stdout')
 	parser.add_argument('--dump', action='store_true', default=False, help='Store raw sent/received data in a dump file named openjvs_dump_<date>_<time>.log.')
+	parser.add_argument('--trace-latency', action='store_true', default=False, help='Trace the latency of every switch read, from sending the request to writing the uinput events. Histograms are logged on SIGUSR2.')
+	parser.add_argument('--trace-interval', type=float, default=None, metavar='SECONDS', help='When tracing latency, also log the histograms every SECONDS seconds.')
 	args = parser.parse_args()
 
 	if args.log_file != None:
 		log_file = open(args.log_file, 'w')
 	else:
 		log_file = sys.stdout
-		
+	start_logging()
+
+	args.config_filename = os.path.abspath(args.config_filename)	# the daemon changes directory, but we need it again on SIGHUP
+
+	return load_mapping(args.config_filename)
 
-	verbose(2, "Reading in config file %s" % args.config_filename)
+# read in the button mapping from a config file
+def load_mapping(filename):
+	verbose(2, "Reading in config file %s", filename)
 	cfg = ConfigParser.ConfigParser()
-	cfg.read(args.config_filename)
+	if not cfg.read(filename):
+		raise IOError("Could not read config file %s" % filename)	# ConfigParser silently skips files it can't open
 
 	joystick_map = { }
 	possible_events = { }
@@ -93,8 +161,12 @@ def read_config():
 
 def init_jvs(args, cfg, joystick_map, possible_events, keyboard_events):
 	verbose(1, "Initializing JVS")
-	jvs_state = jvs.JVS(args.serial_device, dump=args.dump)
-	verbose(2, "Opened device %s" % jvs_state.ser.name)
+	if args.trace_latency:
+		tracer = jvs.LatencyTracer()
+	else:
+		tracer = None
+	jvs_state = jvs.JVS(args.serial_device, dump=args.dump, tracer=tracer)
+	verbose(2, "Opened device %s", jvs_state.ser.name)
 
 	verbose(2, "Resetting bus, assigning address, identifying device")
 	jvs_state.reset(args.assume_devices)
@@ -106,50 +178,130 @@ def init_jvs(args, cfg, joystick_map, possible_events, keyboard_events):
 	verbose(3, "Devices:")
 
 	jvs_state.keyboard_device = uinput.Device(keyboard_events, name='openjvs_keyboard')
+	jvs_state.keyboard_events = keyboard_events
 
 	for device in jvs_state.devices:
 		# dump data about device
-		if args.verbose >= 3:
-			print("\t- Address %d:" % device.address)
-
-			# id data
-			print("\t\t- ID:")
-			for (id_key, id_string) in enumerate(device.id_data):
-				print("\t\t\t- %s: %s" % (id_meanings[id_key], id_string))
-			print
-
-			# version numbers
-			print("\t\t- Versions:")
-			for (version_key, version_number) in device.versions.items():
-				print("\t\t\t- %s: %1.1f" % (version_key, version_number))
-			print
-
-			# capability data
-			print("\t\t- Capabilities:")
-			for (cap_key, cap_args) in device.capabilities.items():
-				print("\t\t\t- %s: %s" % (cap_key, repr(cap_args)))
-			print
+		verbose(3, "\t- Address %d:", device.address)
+
+		# id data
+		verbose(3, "\t\t- ID:")
+		for (id_key, id_string) in enumerate(device.id_data):
+			verbose(3, "\t\t\t- %s: %s", id_meanings[id_key], id_string)
+
+		# version numbers
+		verbose(3, "\t\t- Versions:")
+		for (version_key, version_number) in device.versions.items():
+			verbose(3, "\t\t\t- %s: %1.1f", version_key, version_number)
+
+		# capability data
+		verbose(3, "\t\t- Capabilities:")
+		for (cap_key, cap_args) in device.capabilities.items():
+			verbose(3, "\t\t\t- %s: %r", cap_key, cap_args)
 
 		# create a system uinput device, and a uinput device for each player, within each capable bus device
+		device.uinput_devices = { }
+		device.possible_events = { }
 		if 'switches' in device.capabilities and device.address in possible_events:
-			device.uinput_devices = { }
-			if 0 in possible_events[device.address]:
-				device.uinput_devices[0] = uinput.Device(possible_events[device.address][0], name='openjvs_a%dsys' % device.address)		# add system device, for TEST and TILT switches
-
-			for player in range(1, device.capabilities['switches']['players']+1):
+			for player in range(0, device.capabilities['switches']['players']+1):
 				if player in possible_events[device.address]:
-					device.uinput_devices[player] = uinput.Device(possible_events[device.address][player], name='openjvs_a%dp%d' % (device.address, player))	# add player device
-					verbose(3, "\t\t- Creating device openjvs_a%dp%d for player %d" % (device.address, player, player))
+					create_uinput_device(device, player, possible_events[device.address][player])
 			verbose(3, "")	# empty line
 	return jvs_state
 
+# name of the uinput device for one player of a bus device, player 0 being the system device for TEST and TILT switches
+def uinput_device_name(device, player):
+	if player == 0:
+		return 'openjvs_a%dsys' % device.address
+	else:
+		return 'openjvs_a%dp%d' % (device.address, player)
+
+# create the uinput device for one player of a bus device
+def create_uinput_device(device, player, events):
+	name = uinput_device_name(device, player)
+	verbose(3, "\t\t- Creating device %s for player %d", name, player)
+	device.uinput_devices[player] = uinput.Device(events, name=name)
+	device.possible_events[player] = events
+
+# re-read the config file and swap in the new mapping, recreating only those uinput devices whose events changed
+def reload_config(jvs_state, joystick_map):
+	verbose(1, "Reloading config file %s", args.config_filename)
+	try:
+		(cfg, new_joystick_map, possible_events, keyboard_events) = load_mapping(args.config_filename)
+	except Exception as e:
+		verbose(1, "Failed to reload config, keeping the old mapping: %r", e)
+		return joystick_map
+
+	# work out which players' devices change, as (bus device, player, new events or None)
+	changes = [ ]
+	for device in jvs_state.devices:
+		if 'switches' not in device.capabilities:
+			continue
+
+		for player in range(0, device.capabilities['switches']['players']+1):
+			events = possible_events.get(device.address, { }).get(player)
+			old_events = device.possible_events.get(player)
+			if (events == None and old_events == None) or (events != None and old_events != None and sorted(events) == sorted(old_events)):
+				continue	# unchanged, keep the existing device
+			changes.append((device, player, events))
+
+	# build all replacement devices before touching the old ones, so a failure leaves everything as it was
+	new_keyboard_device = None
+	new_devices = [ ]
+	try:
+		if sorted(keyboard_events) != sorted(jvs_state.keyboard_events):
+			verbose(2, "Recreating keyboard device")
+			new_keyboard_device = uinput.Device(keyboard_events, name='openjvs_keyboard')
+		for (device, player, events) in changes:
+			if events != None:
+				verbose(3, "Recreating device %s", uinput_device_name(device, player))
+				new_devices.append(uinput.Device(events, name=uinput_device_name(device, player)))
+			else:
+				new_devices.append(None)
+	except Exception as e:
+		verbose(1, "Failed to create uinput devices, keeping the old mapping: %r", e)
+		for new_device in new_devices + [ new_keyboard_device ]:
+			if new_device != None:
+				new_device.destroy()
+		return joystick_map
+
+	# everything is in place, swap the new devices in and get rid of the old ones
+	if new_keyboard_device != None:
+		jvs_state.keyboard_device.destroy()
+		jvs_state.keyboard_device = new_keyboard_device
+		jvs_state.keyboard_events = keyboard_events
+
+	for ((device, player, events), new_device) in zip(changes, new_devices):
+		if player in device.uinput_devices:
+			verbose(3, "Removing old device for address %d player %d", device.address, player)
+			device.uinput_devices.pop(player).destroy()
+			del device.possible_events[player]
+		if new_device != None:
+			device.uinput_devices[player] = new_device
+			device.possible_events[player] = events
+
+	return new_joystick_map
+
 def cleanup_handler(signal, frame):
 	global do_exit
-	verbose(1, "Shutting down.")
 	do_exit = True
 
+def reload_handler(signal, frame):
+	global do_reload
+	do_reload = True
+
+def latency_handler(signal, frame):
+	global do_dump_latency
+	do_dump_latency = True
+
+# log the latency histograms collected so far
+def dump_latency(tracer):
+	verbose(0, "Latency per stage:")
+	for line in tracer.report():
+		verbose(0, "\t%s", line)
+
 def main_loop(jvs_state, cfg, joystick_map):
-	global do_exit
+	global do_exit, do_reload, do_dump_latency
 
 	# for reading out switches
 	status_str = ''
@@ -159,15 +311,41 @@ def main_loop(jvs_state, cfg, joystick_map):
 	# hook SIGTERM to exit gracefully
 	do_exit = False
 
+	# SIGHUP swaps in a new mapping between polls, so the bus never notices
+	do_reload = False
+
+	# latency histograms are dumped on SIGUSR2 and, optionally, periodically
+	tracer = jvs_state.tracer
+	do_dump_latency = False
+	if tracer and args.trace_interval:
+		next_latency_dump = time.time() + args.trace_interval
+	else:
+		next_latency_dump = None
+
 	# main loop
 	verbose(1, "Entering main loop...")
 
 	while not do_exit:
+		if do_reload:
+			do_reload = False
+			joystick_map = reload_config(jvs_state, joystick_map)
+			old_sw = None	# report every switch state again, to the new devices as well
+
+		if tracer:
+			if next_latency_dump != None and time.time() >= next_latency_dump:
+				do_dump_latency = True
+				next_latency_dump += args.trace_interval
+			if do_dump_latency:
+				dump_latency(tracer)
+				do_dump_latency = False
+
 		for device in jvs_state.devices:
 			if 'switches' in device.capabilities:
 				try:
 					sw = jvs_state.read_switches(device.address, device.capabilities['switches']['players'])
 					if device.address in joystick_map:
+						# compare states first, collecting the events to write as (uinput device, event, value)
+						events = [ ]
 						for player_id in range(0, device.capabilities['switches']['players']+1):
 							if player_id in joystick_map[device.address]:
 								for map_entry in joystick_map[device.address][player_id]:
@@ -175,28 +353,41 @@ def main_loop(jvs_state, cfg, joystick_map):
 										for swid in map_entry[2]:
 											if (old_sw == None) or (old_sw[player_id][swid] != sw[player_id][swid]):
 												if sw[player_id][swid]:
-													device.uinput_devices[player_id].emit(map_entry[1], 1, syn=False)
+													events.append((device.uinput_devices[player_id], map_entry[1], 1))
 												else:
-													device.uinput_devices[player_id].emit(map_entry[1], 0, syn=False)
+													events.append((device.uinput_devices[player_id], map_entry[1], 0))
 
 									elif map_entry[0] == 'axis': 
-										device.uinput_devices[player_id].emit(map_entry[1], 1 + sw[player_id][map_entry[2]] - sw[player_id][map_entry[3]], syn=False)
+										events.append((device.uinput_devices[player_id], map_entry[1], 1 + sw[player_id][map_entry[2]] - sw[player_id][map_entry[3]]))
 
 									elif map_entry[0] == 'keyboard':
 										for swid in map_entry[2]:
 											if (old_sw == None) or (old_sw[player_id][swid] != sw[player_id][swid]):
 												if sw[player_id][swid]:
-													jvs_state.keyboard_device.emit(map_entry[1], 1, syn=False)
+													events.append((jvs_state.keyboard_device, map_entry[1], 1))
 												else:
-													jvs_state.keyboard_device.emit(map_entry[1], 0, syn=False)
+													events.append((jvs_state.keyboard_device, map_entry[1], 0))
 
 									else:
 										raise ValueError
+						if tracer:
+							tracer.mark('diff')
+
+						# then write them out and fire them
+						for (uinput_device, event, value) in events:
+							uinput_device.emit(event, value, syn=False)
+						for player_id in range(0, device.capabilities['switches']['players']+1):
+							if player_id in joystick_map[device.address]:
 								device.uinput_devices[player_id].syn()	# fire all events
+						jvs_state.keyboard_device.syn()
+						if tracer:
+							tracer.mark('uinput')
+							tracer.end()
 					old_sw = sw
 				except jvs.TimeoutError:
 					verbose(2, "Timeout occurred while reading switches.")
-		jvs_state.keyboard_device.syn()
+
+	verbose(1, "Shutting down.")	# logged here rather than in the signal handler, which must not touch the log queue
 
 # entrypoint
 (cfg, joystick_map, possible_events, keyboard_events) = read_config()
@@ -204,6 +395,8 @@ def main_loop(jvs_state, cfg, joystick_map):
 try:
 	jvs_state = init_jvs(args, cfg, joystick_map, possible_events, keyboard_events)
 	if args.no_daemon:
+		signal.signal(signal.SIGHUP, reload_handler)
+		signal.signal(signal.SIGUSR2, latency_handler)
 		main_loop(jvs_state, cfg, joystick_map)
 	else:
 		pidfile = daemon.pidlockfile.PIDLockFile(args.pid_file)
@@ -211,18 +404,27 @@ try:
 
 		context.signal_map = {
 				signal.SIGTERM: cleanup_handler,
-				signal.SIGUSR1: cleanup_handler
+				signal.SIGUSR1: cleanup_handler,
+				signal.SIGHUP: reload_handler,
+				signal.SIGUSR2: latency_handler
 			}
 
 		context.files_preserve = [ log_file, jvs_state.ser.fileno(), jvs_state.keyboard_device._Device__uinput_fd ]
 		for device in jvs_state.devices:
 			for udevice in device.uinput_devices.values():
-				verbose(3, "%s : %s" % (device, udevice));
+				verbose(3, "%s : %s", device, udevice);
 				context.files_preserve.append(udevice._Device__uinput_fd)
 
 		verbose(1, "Forking to background.")
+		stop_logging()					# threads don't survive the fork, so restart the log thread inside
 
 		with context:
+			start_logging()
 			main_loop(jvs_state, cfg, joystick_map)
+except KeyboardInterrupt:
+	verbose(1, "Shutting down.")
 except Exception as e:
+	stop_logging()						# write out queued messages before the traceback
 	traceback.print_exc(None, log_file)
+finally:
+	stop_logging()						# the log thread is a daemon thread, so anything still queued would be lost on exit
@@ -0,0 +1,295 @@
+# jvs_protocol.py -- table-driven description of the JVS protocol
+"""
+This file describes the layout of commands, replies and capability
+structures, built from the constants in jvs_constants.py. Decoders are
+generated from the tables once at import, and are shared by the master,
+the slave and the snoop tool. Supporting a new command only means adding
+a line to COMMAND_TABLE.
+"""
+
+# imports
+from jvs_constants import *
+
+# argument and reply layouts
+FIXED			= 'fixed'			# (FIXED, n): n bytes
+STRING			= 'string'			# (STRING,): NUL-terminated string
+COUNTED			= 'counted'			# (COUNTED, size): a count byte, then that many items of size bytes
+PRODUCT			= 'product'			# (PRODUCT, base, scale): base + scale * the product of the request's arguments
+CAPABILITY_LIST	= 'capabilities'	# (CAPABILITY_LIST,): 4-byte capability records up to CAP_END
+NO_REPLY		= None				# the command is not answered
+
+# code: (name, description, argument layout, reply layout); reply layouts don't include the report byte
+COMMAND_TABLE = {
+	# broadcast commands
+	CMD_RESET:				('reset',			'bus reset',							(FIXED, 1),		NO_REPLY),
+	CMD_ASSIGN_ADDR:		('assign_addr',		'assign addr',							(FIXED, 1),		(FIXED, 0)),
+	CMD_SET_COMMS_MODE:		('set_comms_mode',	'set communications mode',				(FIXED, 1),		(FIXED, 0)),
+
+	# initialization commands
+	CMD_REQUEST_ID:			('request_id',		'read ID data',							(FIXED, 0),		(STRING,)),
+	CMD_COMMAND_VERSION:	('command_version',	'get command format version',			(FIXED, 0),		(FIXED, 1)),
+	CMD_JVS_VERSION:		('jvs_version',		'get JVS version',						(FIXED, 0),		(FIXED, 1)),
+	CMD_COMMS_VERSION:		('comms_version',	'get communications version',			(FIXED, 0),		(FIXED, 1)),
+	CMD_CAPABILITIES:		('capabilities',	'get slave features',					(FIXED, 0),		(CAPABILITY_LIST,)),
+	CMD_CONVEY_ID:			('convey_id',		'convey ID data of main board',			(STRING,),		(FIXED, 0)),
+
+	# input commands
+	CMD_READ_SWITCHES:		('read_switches',	'read switch inputs',					(FIXED, 2),		(PRODUCT, 1, 1)),
+	CMD_READ_COINS:			('read_coins',		'read coin inputs',						(FIXED, 1),		(PRODUCT, 0, 2)),
+	CMD_READ_ANALOGS:		('read_analogs',	'read analog inputs',					(FIXED, 1),		(PRODUCT, 0, 2)),
+	CMD_READ_ROTARY:		('read_rotary',		'read rotary inputs',					(FIXED, 1),		(PRODUCT, 0, 2)),
+	CMD_READ_KEYPAD:		('read_keypad',		'read keypad input',					(FIXED, 0),		(FIXED, 1)),
+	CMD_READ_LIGHTGUN:		('read_lightgun',	'read screen pointer position',			(FIXED, 1),		(FIXED, 4)),
+	CMD_READ_GPI:			('read_gpi',		'read general-purpose input',			(FIXED, 1),		(PRODUCT, 0, 1)),
+	CMD_READ_PAYOUTS:		('read_payouts',	'read number of payouts remaining',		(FIXED, 1),		(FIXED, 4)),
+	CMD_RETRANSMIT:			('retransmit',		'request data retransmit',				(FIXED, 0),		NO_REPLY),	# the previous reply is sent again instead
+
+	# output commands
+	CMD_DECREASE_COINS:		('decrease_coins',	'decrease the number of coins',			(FIXED, 3),		(FIXED, 0)),
+	CMD_PAYOUT:				('payout',			'do a payout?',							(FIXED, 3),		(FIXED, 0)),
+	CMD_WRITE_GPO:			('write_gpo',		'general-purpose output',				(COUNTED, 1),	(FIXED, 0)),
+	CMD_WRITE_ANALOG:		('write_analog',	'analog output',						(COUNTED, 2),	(FIXED, 0)),
+	CMD_WRITE_DISPLAY:		('write_display',	'output character data',				(COUNTED, 1),	(FIXED, 0)),
+	CMD_INCREASE_COINS:		('increase_coins',	'output coins?',						(FIXED, 3),		(FIXED, 0)),
+	CMD_DECREASE_PAYOUTS:	('decrease_payouts','subtract payouts?',					(FIXED, 3),		(FIXED, 0)),
+	CMD_WRITE_GPO2:			('write_gpo2',		'general-purpose output 2',				(FIXED, 2),		(FIXED, 0)),
+	CMD_WRITE_GPO3:			('write_gpo3',		'general-purpose output 3',				(FIXED, 2),		(FIXED, 0)),
+}
+
+# capability code: (key, fields); fields is BYTE for a single byte, WORD for two bytes, FLAG for presence only,
+# or a tuple of field names for a dict, where a (name, values) pair looks the byte up in values
+BYTE	= 'byte'
+WORD	= 'word'
+FLAG	= 'flag'
+
+CAPABILITY_TABLE = {
+	# inputs
+	CAP_PLAYERS:	('switches',	('players', 'switches')),
+	CAP_COINS:		('coins',		BYTE),
+	CAP_ANALOG_IN:	('analog_in',	('channels', 'bits')),
+	CAP_ROTARY:		('rotary',		BYTE),
+	CAP_KEYPAD:		('keypad',		FLAG),
+	CAP_LIGHTGUN:	('lightgun',	('xbits', 'ybits', 'channels')),
+	CAP_GPI:		('gpi',			WORD),
+
+	# outputs
+	CAP_CARD:		('card',		BYTE),
+	CAP_HOPPER:		('hopper',		BYTE),
+	CAP_GPO:		('gpo',			BYTE),
+	CAP_ANALOG_OUT:	('analog_out',	BYTE),
+	CAP_DISPLAY:	('display',		('cols', 'rows', ('enc', ENCODINGS))),
+	CAP_BACKUP:		('backup',		FLAG),
+}
+
+# position of every named switch in a switch reply, as (byte, mask) relative to the start of its player's data
+GENERAL_SWITCHES = {	 'test':(0, BTN_GENERAL_TEST),
+						'tilt1':(0, BTN_GENERAL_TILT1),
+						'tilt2':(0, BTN_GENERAL_TILT2),
+						'tilt3':(0, BTN_GENERAL_TILT3) }
+
+PLAYER_SWITCHES = {	  'start':(0, BTN_PLAYER_START),
+					'service':(0, BTN_PLAYER_SERVICE),
+					     'up':(0, BTN_PLAYER_UP),
+					   'down':(0, BTN_PLAYER_DOWN),
+					   'left':(0, BTN_PLAYER_LEFT),
+					  'right':(0, BTN_PLAYER_RIGHT),
+					  'push1':(0, BTN_PLAYER_PUSH1),
+					  'push2':(0, BTN_PLAYER_PUSH2),
+
+					  'push3':(1, BTN_PLAYER_PUSH3),
+					  'push4':(1, BTN_PLAYER_PUSH4),
+					  'push5':(1, BTN_PLAYER_PUSH5),
+					  'push6':(1, BTN_PLAYER_PUSH6),
+					  'push7':(1, BTN_PLAYER_PUSH7),
+					  'push8':(1, BTN_PLAYER_PUSH8),
+					  'push9':(1, BTN_PLAYER_PUSH9) }
+
+# generators for the precompiled decoders
+def compile_layout(layout):
+	"""Turns a layout into a function of (args, data, position) giving the number of bytes it takes up in data from position on, or None if data is too short."""
+	kind = layout[0]
+	if kind == FIXED:
+		size = layout[1]
+		def length(args, data, position):
+			return size
+	elif kind == STRING:
+		def length(args, data, position):
+			if 0 not in data[position:]:
+				return None
+			return data.index(0, position) - position + 1
+	elif kind == COUNTED:
+		size = layout[1]
+		def length(args, data, position):
+			if position >= len(data):
+				return None
+			return 1 + data[position] * size
+	elif kind == PRODUCT:
+		(base, scale) = layout[1:]
+		def length(args, data, position):
+			product = 1
+			for arg in args:
+				product *= arg
+			return base + scale * product
+	elif kind == CAPABILITY_LIST:
+		def length(args, data, position):
+			end = position
+			while end < len(data) and data[end] != CAP_END:
+				end += 4
+			if end >= len(data):
+				return None
+			return end - position + 1
+	else:
+		raise ValueError(layout)
+
+	def checked_length(args, data, position):
+		size = length(args, data, position)
+		if size == None or position + size > len(data):
+			return None
+		return size
+	return checked_length
+
+def compile_capability(key, fields):
+	"""Generates a decoder from the three argument bytes of a capability record to its value, and an encoder back."""
+	if fields == BYTE:
+		decode = lambda record: record[0]
+		encode = lambda value: [ value, 0, 0 ]
+	elif fields == WORD:
+		decode = lambda record: (record[0]<<8) | record[1]
+		encode = lambda value: [ value >> 8, value & 0xFF, 0 ]
+	elif fields == FLAG:
+		decode = lambda record: True
+		encode = lambda value: [ 0, 0, 0 ]
+	else:
+		names	= [ ]
+		tables	= { }
+		for field in fields:
+			if isinstance(field, tuple):
+				tables[field[0]] = field[1]
+				field = field[0]
+			names.append(field)
+
+		def decode(record):
+			value = dict(zip(names, record))
+			for (name, table) in tables.items():
+				value[name] = table[value[name]]
+			return value
+		def encode(value):
+			record = [ ]
+			for name in names:
+				if name in tables:
+					record.append(tables[name].index(value[name]))
+				else:
+					record.append(value[name])
+			return record + [ 0 ] * (3 - len(record))
+	return (key, decode, encode)
+
+class Command:
+	"""Description of a command, with precompiled functions for the lengths of its arguments and its reply."""
+	def __init__(self, code, name, description, argument_layout, reply_layout):
+		self.code				= code
+		self.name				= name
+		self.description		= description
+		self.argument_length	= compile_layout(argument_layout)
+		if reply_layout == NO_REPLY:
+			self.reply_length	= None
+		else:
+			self.reply_length	= compile_layout(reply_layout)
+
+# the precompiled decoders
+COMMANDS		= dict((code, Command(code, *entry)) for (code, entry) in COMMAND_TABLE.items())
+CAPABILITIES	= dict((code, compile_capability(*entry)) for (code, entry) in CAPABILITY_TABLE.items())
+CAPABILITY_KEYS	= dict((entry[0], code) for (code, entry) in CAPABILITY_TABLE.items())
+
+GENERAL_SWITCH_LIST	= [ (name, byte, mask) for (name, (byte, mask)) in GENERAL_SWITCHES.items() ]
+PLAYER_SWITCH_LIST	= [ (name, byte, mask) for (name, (byte, mask)) in PLAYER_SWITCHES.items() ]
+
+# the player switches that fit in a given number of bytes per player; more bytes than this hold all of them
+PLAYER_SWITCH_LISTS	= dict((player_bytes, [ entry for entry in PLAYER_SWITCH_LIST if entry[1] < player_bytes ])
+	for player_bytes in range(0, max(byte for (byte, mask) in PLAYER_SWITCHES.values()) + 2))
+
+def describe_command(code):
+	"""Returns a human-readable description of a command code."""
+	if code in COMMANDS:
+		return COMMANDS[code].description
+	elif code >= CMD_MANUFACTURER_START and code <= CMD_MANUFACTURER_END:
+		return 'manufacturer-specific'
+	else:
+		return 'unknown command'
+
+def split_commands(data):
+	"""
+	Splits the data of a request packet into a list of (code, args) pairs. A command whose arguments can't be
+	determined, because it is unknown or its arguments are cut short, ends the list with args None.
+	"""
+	commands = [ ]
+	position = 0
+	while position < len(data):
+		code = data[position]
+		if code not in COMMANDS:
+			commands.append((code, None))
+			break
+
+		length = COMMANDS[code].argument_length(None, data, position+1)
+		if length == None:
+			commands.append((code, None))
+			break
+
+		commands.append((code, data[position+1:position+1+length]))
+		position += 1 + length
+	return commands
+
+def split_replies(commands, data):
+	"""
+	Splits the data of a reply packet, given the commands of the request as returned by split_commands, into the
+	status byte and a list of (code, report, reply data) triples. Stops at the first reply that can't be decoded.
+	"""
+	status = data[0]
+	replies = [ ]
+	position = 1
+	if status != STATUS_SUCCESS:
+		return (status, replies)
+
+	for (code, args) in commands:
+		if args == None or COMMANDS[code].reply_length == None or position >= len(data):
+			break
+
+		report = data[position]
+		length = COMMANDS[code].reply_length(args, data, position+1)
+		if report != REPORT_SUCCESS or length == None:
+			replies.append((code, report, data[position+1:]))
+			break
+
+		replies.append((code, report, data[position+1:position+1+length]))
+		position += 1 + length
+	return (status, replies)
+
+def decode_capabilities(data):
+	"""Decodes a capability structure into a dict of capabilities."""
+	capabilities = { }
+	for position in range(0, len(data), 4):
+		if data[position] == CAP_END:
+			break
+		if data[position] in CAPABILITIES:
+			(key, decode, encode) = CAPABILITIES[data[position]]
+			capabilities[key] = decode(data[position+1:position+4])
+	return capabilities
+
+def encode_capabilities(capabilities):
+	"""Encodes a dict of capabilities, as returned by decode_capabilities, into a capability structure."""
+	data = [ ]
+	for code in sorted(CAPABILITY_KEYS[key] for key in capabilities):
+		(key, decode, encode) = CAPABILITIES[code]
+		data += [ code ] + encode(capabilities[key])
+	return data + [ CAP_END ]
+
+def decode_switches(data, num_players, player_bytes = 2):
+	"""
+	Decodes a switch reply into a list of dicts by player and then by switch name. Player 0 contains the general
+	switch states. Switches that don't fit in player_bytes are left out.
+	"""
+	player_switches = PLAYER_SWITCH_LISTS.get(player_bytes, PLAYER_SWITCH_LIST)
+	ret = [ dict((name, bool(data[byte] & mask)) for (name, byte, mask) in GENERAL_SWITCH_LIST) ]
+	for player in range(0, num_players):
+		player_data = data[1 + player*player_bytes:1 + (player+1)*player_bytes]
+		ret.append(dict((name, bool(player_data[byte] & mask)) for (name, byte, mask) in player_switches))
+	return ret